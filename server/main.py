@@ -23,27 +23,73 @@ Versión: 2.0.0
 """
 
 import os
+import re
+import time
+import queue
+import sqlite3
+import atexit
+import asyncio
 import logging
+import logging.handlers
+import math
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional
+from functools import lru_cache
+from itertools import islice
+from typing import Literal
+from urllib.parse import unquote
 
+import diskcache
 import httpx
+import orjson
 from fastapi import FastAPI
 from fastapi import HTTPException
 from fastapi import Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from fastapi.responses import JSONResponse
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from pydantic import ConfigDict
 from pydantic import Field
+from pydantic import TypeAdapter
+from pydantic import ValidationError
+from pydantic import field_validator
 
 
 # =============================================================================
 #                           CONFIGURACIÓN DE LOGGING
 # =============================================================================
 
+# Los registros se encolan (QueueHandler) y un hilo aparte los escribe en
+# stderr (QueueListener), para que la E/S de logging no bloquee el event loop.
+_cola_logs: queue.SimpleQueue = queue.SimpleQueue()
+
+_manejador_consola = logging.StreamHandler()
+_manejador_consola.setFormatter(logging.Formatter(
+    fmt='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+))
+
+_listener_logs = logging.handlers.QueueListener(
+    _cola_logs,
+    _manejador_consola,
+    respect_handler_level=True
+)
+_listener_logs.start()
+atexit.register(_listener_logs.stop)
+
+# El formato final lo aplica el manejador de consola; aquí solo el mensaje
+_manejador_cola = logging.handlers.QueueHandler(_cola_logs)
+_manejador_cola.setFormatter(logging.Formatter('%(message)s'))
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    handlers=[_manejador_cola]
 )
 
 logger = logging.getLogger(__name__)
@@ -63,6 +109,12 @@ NOTION_ESTRATEGIAS_DB_ID = os.environ.get("NOTION_ESTRATEGIAS_DB_ID", "")
 # Base de datos opcional para drawdown
 NOTION_DRAWDOWN_DB_ID = os.environ.get("NOTION_DRAWDOWN_DB_ID", "")
 
+# Directorio de la cache persistente de page_ids de relaciones
+NOTION_CACHE_DIR = os.environ.get("NOTION_CACHE_DIR", "/tmp/notion-cache")
+
+# Diario SQLite de los trades recibidos por /trade aún no enviados a Notion
+TRADE_WAL_PATH = os.environ.get("TRADE_WAL_PATH", "/tmp/trades-pendientes.sqlite3")
+
 # Validar configuración al inicio
 if not NOTION_API_KEY:
     logger.warning("⚠️  NOTION_API_KEY no está configurada.")
@@ -70,19 +122,142 @@ if not NOTION_API_KEY:
 if not NOTION_DATABASE_ID:
     logger.warning("⚠️  NOTION_DATABASE_ID no está configurada.")
 
-# Cache para IDs de páginas de relaciones (evita búsquedas repetidas)
-_cache_cuentas: dict[str, str] = {}
-_cache_estrategias: dict[int, str] = {}
+# Cache para IDs de páginas de relaciones (evita búsquedas repetidas).
+# Cada entrada guarda (page_id, expira_en). Los fallos ("") también se cachean,
+# pero con un TTL corto para no repetir la consulta en cada trade sin quedar
+# envenenados por un error transitorio de Notion.
+CACHE_TTL = 3600
+CACHE_TTL_FALLO = 60
+
+_cache_cuentas: dict[str, tuple[str, float]] = {}
+_cache_estrategias: dict[int, tuple[str, float]] = {}
+
+# Segundo nivel en disco (solo page_ids resueltos) para que los reinicios del
+# servidor no obliguen a volver a resolver todas las relaciones en Notion.
+# Clave: (tipo, database_id, valor buscado). Tamaño acotado por size_limit.
+CACHE_TTL_DISCO = 7 * 24 * 3600
+
+try:
+    _cache_disco: diskcache.Cache | None = diskcache.Cache(NOTION_CACHE_DIR, size_limit=50 * 2**20)
+except Exception as e:
+    logger.warning("⚠️  Cache en disco no disponible (%s): %s", NOTION_CACHE_DIR, e)
+    _cache_disco = None
+
+# Esquemas de las bases de datos de Notion: nombre de propiedad -> id
+_esquemas_notion: dict[str, dict[str, str]] = {}
+
+# Resoluciones en curso (single-flight): peticiones concurrentes de una
+# cuenta/estrategia nueva esperan el resultado de la primera en lugar de
+# crear páginas duplicadas en Notion. La entrada se elimina al terminar.
+_en_curso_cuentas: dict[str, asyncio.Task] = {}
+_en_curso_estrategias: dict[int, asyncio.Task] = {}
+
+# Cache corta de tickets por cuenta para /tickets: el EA la consulta en cada
+# sincronización. Solo se cachean consultas exitosas; la entrada de una cuenta
+# se invalida al registrar un trade suyo.
+TICKETS_CACHE_TTL = 30
+TICKETS_CACHE_MAX = 256
+
+_cache_tickets: dict[str, tuple[list[int], float]] = {}
+_en_curso_tickets: dict[str, asyncio.Task] = {}
 
 
 # =============================================================================
 #                           CONFIGURACIÓN DE NOTION
 # =============================================================================
 
-NOTION_API_URL = "https://api.notion.com/v1/pages"
-NOTION_QUERY_URL = "https://api.notion.com/v1/databases"
+NOTION_BASE_URL = "https://api.notion.com"
+NOTION_PAGES_PATH = "/v1/pages"
+NOTION_DATABASES_PATH = "/v1/databases"
 NOTION_VERSION = "2022-06-28"
 
+# Headers necesarios para las peticiones a Notion (fijos durante toda la ejecución)
+NOTION_HEADERS = {
+    "Authorization": f"Bearer {NOTION_API_KEY}",
+    "Content-Type": "application/json",
+    "Notion-Version": NOTION_VERSION
+}
+
+# Bloques "parent" de cada base de datos: son constantes, se comparten entre
+# payloads (solo se serializan, nunca se modifican)
+_PARENT_TRADES = {"database_id": NOTION_DATABASE_ID}
+_PARENT_CUENTAS = {"database_id": NOTION_CUENTAS_DB_ID}
+_PARENT_ESTRATEGIAS = {"database_id": NOTION_ESTRATEGIAS_DB_ID}
+_PARENT_DRAWDOWN = {"database_id": NOTION_DRAWDOWN_DB_ID}
+
+# Qué hacer con cada drawdown recibido, resuelto una vez al arrancar:
+#   "disabled": Notion no configurado, solo se acusa recibo
+#   "logged":   sin base de datos de drawdown, se registra en los logs
+#   "notion":   se guarda en NOTION_DRAWDOWN_DB_ID
+if not NOTION_API_KEY or not (NOTION_DRAWDOWN_DB_ID or NOTION_DATABASE_ID):
+    _MODO_DRAWDOWN = "disabled"
+elif not NOTION_DRAWDOWN_DB_ID:
+    _MODO_DRAWDOWN = "logged"
+else:
+    _MODO_DRAWDOWN = "notion"
+
+# Máximo de trades procesados en paralelo dentro de un lote
+MAX_TRADES_CONCURRENTES = 5
+
+# Límites de /sync y /trade/batch (por encima se responde 413) y tamaño de
+# las tandas en que se lanzan las tareas de un lote
+MAX_TRADES_POR_LOTE = 5000
+TAMANO_MAX_CUERPO_LOTE = 5 * 2**20
+TAMANO_TROZO_LOTE = 500
+
+# Límite de peticiones a Notion (su API admite ~3 por segundo de media):
+# se permiten ráfagas cortas y los 429 se reintentan respetando Retry-After
+NOTION_PETICIONES_POR_SEGUNDO = 3.0
+NOTION_RAFAGA = 3
+NOTION_MAX_REINTENTOS = 4
+
+# Momento (time.monotonic) a partir del cual se puede hacer la siguiente petición
+_siguiente_turno_notion = 0.0
+
+# Cola de trades en tiempo real: /trade encola y un worker los envía a Notion
+TAMANO_COLA_TRADES = 10_000
+TRADES_POR_LOTE_WORKER = 10
+VENTANA_LOTE_WORKER = 0.1
+MAX_TRADES_CONCURRENTES_WORKER = 3
+
+# Reintentos de los trades que el worker no pudo registrar (Notion caído,
+# error de conexión, rate limit...): se reencolan con backoff exponencial.
+# Agotados los reintentos siguen en el diario y se reenvían en el próximo
+# arranque. Los rechazos definitivos (otros 4xx) no se reintentan.
+REINTENTOS_MAX_WORKER = 8
+ESPERA_BASE_REINTENTO = 5.0
+ESPERA_MAX_REINTENTO = 300.0
+
+_reintentos_trades: dict[int, int] = {}
+_tareas_reintento: set[asyncio.Task] = set()
+
+_cola_trades: asyncio.Queue | None = None
+_worker_trades: asyncio.Task | None = None
+
+# Diario (SQLite en modo WAL) de los trades encolados: /trade responde 202
+# antes de escribir en Notion, así que un reinicio no debe perderlos. Al
+# arrancar se vuelven a encolar; se borran al registrarse (u omitirse).
+try:
+    _wal_trades: sqlite3.Connection | None = sqlite3.connect(
+        TRADE_WAL_PATH, isolation_level=None, check_same_thread=False
+    )
+    _wal_trades.execute("PRAGMA journal_mode=WAL")
+    _wal_trades.execute("PRAGMA synchronous=NORMAL")
+    _wal_trades.execute(
+        "CREATE TABLE IF NOT EXISTS pendientes (ticket INTEGER PRIMARY KEY, datos TEXT NOT NULL)"
+    )
+    atexit.register(_wal_trades.close)
+except sqlite3.Error as e:
+    logger.warning("⚠️  Diario de trades pendientes no disponible (%s): %s", TRADE_WAL_PATH, e)
+    _wal_trades = None
+
+# Un único hilo para el diario: serializa el acceso a la conexión SQLite
+_executor_wal = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wal")
+
+# Cliente HTTP compartido: mantiene conexiones keep-alive (HTTP/2) con Notion
+# para no pagar el handshake TCP+TLS en cada petición.
+_client: httpx.AsyncClient | None = None
+
 
 # =============================================================================
 #                           MODELOS DE DATOS
@@ -93,6 +268,8 @@ class TradeData(BaseModel):
     Modelo para los datos de una operación de trading recibida desde MT4.
     """
     
+    model_config = ConfigDict(extra="ignore", frozen=True)
+    
     identificador_cuenta: str = Field(
         ...,
         description="Identificador único de la cuenta/terminal (ej: FTMO_01)"
@@ -113,7 +290,7 @@ class TradeData(BaseModel):
         description="Par de divisas o instrumento (ej: EURUSD)"
     )
     
-    direccion: str = Field(
+    direccion: Literal["BUY", "SELL"] = Field(
         ...,
         description="Dirección de la operación (BUY o SELL)"
     )
@@ -128,7 +305,7 @@ class TradeData(BaseModel):
         description="Profit/Loss total de la operación"
     )
     
-    resultado: str = Field(
+    resultado: Literal["WIN", "LOSS"] = Field(
         ...,
         description="Resultado de la operación (WIN o LOSS)"
     )
@@ -138,7 +315,7 @@ class TradeData(BaseModel):
         description="Balance de la cuenta después del cierre"
     )
     
-    fecha_apertura: Optional[str] = Field(
+    fecha_apertura: str | None = Field(
         default=None,
         description="Fecha y hora de apertura (ISO 8601)"
     )
@@ -148,10 +325,27 @@ class TradeData(BaseModel):
         description="Fecha y hora de cierre (ISO 8601)"
     )
     
-    comentario: Optional[str] = Field(
+    comentario: str | None = Field(
         default="",
         description="Comentario de la orden"
     )
+    
+    # Validaciones: un trade inválido se rechaza con 422 antes de
+    # consumir ninguna petición a Notion.
+    
+    @field_validator("ticket")
+    @classmethod
+    def validar_ticket(cls, valor: int) -> int:
+        if valor <= 0:
+            raise ValueError("El ticket debe ser un número positivo")
+        return valor
+    
+    @field_validator("lotes", "balance")
+    @classmethod
+    def validar_finito(cls, valor: float) -> float:
+        if not math.isfinite(valor):
+            raise ValueError("El valor debe ser un número finito")
+        return valor
 
 
 class DrawdownData(BaseModel):
@@ -159,6 +353,8 @@ class DrawdownData(BaseModel):
     Modelo para los datos de drawdown recibidos desde MT4.
     """
     
+    model_config = ConfigDict(extra="ignore", frozen=True)
+    
     identificador_cuenta: str = Field(
         ...,
         description="Identificador único de la cuenta/terminal"
@@ -215,14 +411,44 @@ class DrawdownData(BaseModel):
     )
 
 
+# Validador de listas de trades, compilado una sola vez (ver parsear_trades_bulk)
+_validador_lista_trades = TypeAdapter(list[TradeData])
+
+
 # =============================================================================
 #                           APLICACIÓN FASTAPI
 # =============================================================================
 
+class RespuestaORJSON(JSONResponse):
+    """
+    Respuesta JSON serializada con orjson en lugar del módulo json estándar.
+    """
+    
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    """
+    Arranque y parada del servidor (ver sección CICLO DE VIDA).
+    """
+    
+    await iniciar_cliente_notion()
+    await precargar_esquema_trades()
+    
+    try:
+        yield
+    finally:
+        await cerrar_cliente_notion()
+
+
 app = FastAPI(
     title="MT4 Trade Logger",
     description="Servidor central para registrar operaciones de trading en Notion",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=RespuestaORJSON,
+    lifespan=ciclo_de_vida
 )
 
 # Configurar CORS para permitir peticiones desde cualquier origen
@@ -239,6 +465,51 @@ app.add_middleware(
 #                           FUNCIONES AUXILIARES
 # =============================================================================
 
+# Fechas "YYYY.MM.DD HH:MM:SS" de MT4 (con '.' o '-', separador 'T' o espacio)
+_FECHA_RE = re.compile(r"^(\d{4})[.-](\d{2})[.-](\d{2})[T ](\d{2}):(\d{2}):(\d{2})$")
+
+# Formatos de respaldo (p. ej. campos sin ceros a la izquierda)
+_FORMATOS_FECHA = (
+    "%Y.%m.%dT%H:%M:%S",    # Formato MT4
+    "%Y-%m-%dT%H:%M:%S",    # ISO estándar
+    "%Y.%m.%d %H:%M:%S",    # Alternativo
+    "%Y-%m-%d %H:%M:%S",    # Alternativo
+)
+
+
+@lru_cache(maxsize=4096)
+def _parsear_fecha(fecha_str: str) -> str | None:
+    """
+    Parsea una fecha de MT4 a ISO 8601, o None si no tiene formato conocido.
+    
+    Se memoriza porque la sincronización de historial repite las mismas
+    fechas de cierre muchas veces.
+    """
+    
+    # Ruta rápida: fromisoformat está implementado en C
+    try:
+        return datetime.fromisoformat(fecha_str).isoformat()
+    except ValueError:
+        pass
+    
+    # Formato MT4: regex precompilada + conversión directa a enteros,
+    # mucho más barata que strptime
+    coincidencia = _FECHA_RE.match(fecha_str)
+    if coincidencia:
+        try:
+            return datetime(*map(int, coincidencia.groups())).isoformat()
+        except ValueError:
+            return None
+    
+    for formato in _FORMATOS_FECHA:
+        try:
+            return datetime.strptime(fecha_str, formato).isoformat()
+        except ValueError:
+            continue
+    
+    return None
+
+
 def formatear_fecha_notion(fecha_str: str) -> str:
     """
     Convierte una fecha de MT4 al formato esperado por Notion.
@@ -253,35 +524,375 @@ def formatear_fecha_notion(fecha_str: str) -> str:
     if not fecha_str:
         return datetime.now().isoformat()
     
-    # Intentar parsear diferentes formatos
-    formatos_posibles = [
-        "%Y.%m.%dT%H:%M:%S",    # Formato MT4
-        "%Y-%m-%dT%H:%M:%S",    # ISO estándar
-        "%Y.%m.%d %H:%M:%S",    # Alternativo
-        "%Y-%m-%d %H:%M:%S",    # Alternativo
-    ]
+    fecha_iso = _parsear_fecha(fecha_str)
     
-    for formato in formatos_posibles:
-        try:
-            fecha_parseada = datetime.strptime(fecha_str, formato)
-            return fecha_parseada.isoformat()
-        except ValueError:
-            continue
+    if fecha_iso is not None:
+        return fecha_iso
     
     # Si no se pudo parsear, devolver la fecha actual
-    logger.warning(f"No se pudo parsear la fecha: {fecha_str}")
+    logger.warning("No se pudo parsear la fecha: %s", fecha_str)
     return datetime.now().isoformat()
 
 
-def get_notion_headers() -> dict:
+def leer_cache(cache: dict, clave) -> str | None:
     """
-    Retorna los headers necesarios para las peticiones a Notion.
+    Retorna el valor cacheado de una clave, o None si no existe o ha expirado.
     """
-    return {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Content-Type": "application/json",
-        "Notion-Version": NOTION_VERSION
-    }
+    
+    entrada = cache.get(clave)
+    
+    if entrada is None:
+        return None
+    
+    valor, expira_en = entrada
+    
+    if expira_en < time.monotonic():
+        del cache[clave]
+        return None
+    
+    return valor
+
+
+def guardar_cache(cache: dict, clave, valor: str) -> None:
+    """
+    Guarda un valor en cache; los resultados vacíos (fallos) expiran antes.
+    """
+    
+    ttl = CACHE_TTL if valor else CACHE_TTL_FALLO
+    cache[clave] = (valor, time.monotonic() + ttl)
+
+
+def crear_cliente_notion() -> httpx.AsyncClient:
+    """
+    Crea el cliente HTTP compartido para la API de Notion.
+    
+    Usa un pool de conexiones keep-alive y HTTP/2 para que varias
+    peticiones de un mismo trade se multiplexen sobre un único socket TLS.
+    Con HTTP/2 cada conexión admite muchos streams concurrentes, así que
+    basta con un pool pequeño.
+    """
+    return httpx.AsyncClient(
+        base_url=NOTION_BASE_URL,
+        headers=NOTION_HEADERS,
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(
+            max_connections=10,
+            max_keepalive_connections=10,
+            keepalive_expiry=60
+        ),
+        http2=True
+    )
+
+
+async def leer_cache_disco(clave: tuple) -> str | None:
+    """
+    Retorna el page_id guardado en la cache en disco, o None si no existe.
+    
+    diskcache usa SQLite (E/S bloqueante), así que se consulta en un hilo
+    para no frenar el event loop. La cache solo acelera: si falla (disco
+    lleno, timeout, cache cerrada...) se trata como un fallo de cache.
+    """
+    
+    if _cache_disco is None:
+        return None
+    
+    try:
+        return await asyncio.to_thread(_cache_disco.get, clave)
+    except Exception as e:
+        logger.warning("Error leyendo la cache en disco: %s", e)
+        return None
+
+
+async def guardar_cache_disco(clave: tuple, page_id: str) -> None:
+    """
+    Guarda un page_id resuelto en la cache en disco (en un hilo).
+    Si falla, se omite: el page_id ya está en la cache en memoria.
+    """
+    
+    if _cache_disco is None:
+        return
+    
+    try:
+        await asyncio.to_thread(_cache_disco.set, clave, page_id, expire=CACHE_TTL_DISCO)
+    except Exception as e:
+        logger.warning("Error guardando en la cache en disco: %s", e)
+
+
+async def guardar_pendiente(trade: TradeData) -> None:
+    """
+    Anota un trade encolado en el diario de pendientes.
+    """
+    
+    if _wal_trades is None:
+        return
+    
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            _executor_wal,
+            _wal_trades.execute,
+            "INSERT OR REPLACE INTO pendientes (ticket, datos) VALUES (?, ?)",
+            (trade.ticket, trade.model_dump_json())
+        )
+    except sqlite3.Error as e:
+        logger.error("Error anotando el trade %s en el diario: %s", trade.ticket, e)
+
+
+async def confirmar_pendientes(tickets: list[int]) -> None:
+    """
+    Borra del diario los trades que ya no hay que reenviar.
+    """
+    
+    if _wal_trades is None or not tickets:
+        return
+    
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            _executor_wal,
+            _wal_trades.executemany,
+            "DELETE FROM pendientes WHERE ticket = ?",
+            [(ticket,) for ticket in tickets]
+        )
+    except sqlite3.Error as e:
+        logger.error("Error limpiando el diario de trades: %s", e)
+
+
+async def cargar_pendientes() -> list[TradeData]:
+    """
+    Lee los trades que quedaron sin enviar en una ejecución anterior.
+    """
+    
+    if _wal_trades is None:
+        return []
+    
+    try:
+        filas = await asyncio.get_running_loop().run_in_executor(
+            _executor_wal,
+            lambda: _wal_trades.execute("SELECT datos FROM pendientes").fetchall()
+        )
+    except sqlite3.Error as e:
+        logger.error("Error leyendo el diario de trades: %s", e)
+        return []
+    
+    trades = []
+    
+    for (datos,) in filas:
+        try:
+            trades.append(TradeData.model_validate_json(datos))
+        except ValidationError as e:
+            logger.error("Trade del diario descartado por inválido: %s", e)
+    
+    return trades
+
+
+# Hilos para validar cuerpos grandes sin bloquear el event loop
+_executor_validacion = ThreadPoolExecutor(max_workers=4, thread_name_prefix="validacion")
+
+
+def parsear_trades_bulk(cuerpo: bytes) -> list[TradeData]:
+    """
+    Parsea y valida el cuerpo JSON de una sincronización masiva.
+    
+    Se ejecuta en _executor_validacion: con miles de trades la validación
+    tarda lo suficiente como para frenar al resto de terminales MT4.
+    validate_json parsea y valida en una sola pasada (pydantic-core), sin
+    construir antes los dicts intermedios.
+    
+    Args:
+        cuerpo: Cuerpo de la petición (lista JSON de trades)
+        
+    Returns:
+        Lista de trades validados
+        
+    Raises:
+        RequestValidationError: Si el JSON o algún trade no es válido (422)
+    """
+    
+    try:
+        return _validador_lista_trades.validate_json(cuerpo)
+    except ValidationError as e:
+        errores = []
+        for error in e.errors(include_url=False):
+            # En un JSON inválido "input" es el cuerpo entero en bytes
+            if error["type"] == "json_invalid":
+                error["input"] = {}
+            errores.append({**error, "loc": ("body", *error["loc"])})
+        raise RequestValidationError(errores)
+
+
+async def resolver_una_vez(en_curso: dict, clave, resolver):
+    """
+    Ejecuta resolver() una sola vez por clave aunque haya llamadas concurrentes.
+    
+    La resolución corre en su propia tarea, registrada en `en_curso`; todas
+    las llamadas (también la primera) la esperan con shield, así que
+    cancelar a una de ellas no cancela ni hace fallar a las demás.
+    
+    Args:
+        en_curso: Mapa clave -> tarea de las resoluciones en curso
+        clave: Clave a resolver (nombre de cuenta, magic number...)
+        resolver: Función sin argumentos que devuelve la corrutina a ejecutar
+        
+    Returns:
+        Resultado de resolver() (page_id, lista de tickets...)
+    """
+    
+    tarea = en_curso.get(clave)
+    
+    if tarea is None:
+        tarea = asyncio.ensure_future(resolver())
+        en_curso[clave] = tarea
+        
+        def terminar(t: asyncio.Future) -> None:
+            if en_curso.get(clave) is t:
+                del en_curso[clave]
+            # Marcar la excepción como leída aunque todos hayan cancelado
+            if not t.cancelled():
+                t.exception()
+        
+        tarea.add_done_callback(terminar)
+    
+    return await asyncio.shield(tarea)
+
+
+def get_notion_client() -> httpx.AsyncClient:
+    """
+    Retorna el cliente HTTP compartido, creándolo si aún no existe.
+    """
+    global _client
+    
+    if _client is None:
+        _client = crear_cliente_notion()
+    
+    return _client
+
+
+async def esperar_turno_notion() -> None:
+    """
+    Limita el ritmo de peticiones a NOTION_PETICIONES_POR_SEGUNDO.
+    
+    Cada llamada reserva el siguiente hueco libre y duerme hasta él; se
+    admiten hasta NOTION_RAFAGA peticiones seguidas tras un periodo de
+    inactividad. La reserva es síncrona, así que no necesita lock.
+    """
+    global _siguiente_turno_notion
+    
+    intervalo = 1.0 / NOTION_PETICIONES_POR_SEGUNDO
+    ahora = time.monotonic()
+    
+    turno = max(_siguiente_turno_notion, ahora - (NOTION_RAFAGA - 1) * intervalo)
+    _siguiente_turno_notion = turno + intervalo
+    
+    if turno > ahora:
+        await asyncio.sleep(turno - ahora)
+
+
+async def solicitar_notion(metodo: str, path: str, **kwargs) -> httpx.Response:
+    """
+    Hace una petición a la API de Notion respetando su rate limit.
+    
+    Las respuestas 429 se reintentan hasta NOTION_MAX_REINTENTOS veces,
+    esperando lo que indique Retry-After o, si no viene, un backoff
+    exponencial (0.5 s, 1 s, 2 s...).
+    
+    Args:
+        metodo: Método HTTP
+        path: Ruta relativa a NOTION_BASE_URL (ej: /v1/pages)
+        **kwargs: Argumentos de httpx.AsyncClient.request
+        
+    Returns:
+        Respuesta HTTP de Notion (la última, si se agotaron los reintentos)
+    """
+    
+    for intento in range(NOTION_MAX_REINTENTOS + 1):
+        await esperar_turno_notion()
+        response = await get_notion_client().request(metodo, path, **kwargs)
+        
+        if response.status_code != 429 or intento == NOTION_MAX_REINTENTOS:
+            return response
+        
+        try:
+            espera = float(response.headers.get("retry-after", ""))
+        except ValueError:
+            espera = 0.5 * 2 ** intento
+        
+        logger.warning("Rate limit de Notion (429): reintento %s en %.1f s", intento + 1, espera)
+        await asyncio.sleep(espera)
+
+
+async def notion_post(path: str, payload: dict, **kwargs) -> httpx.Response:
+    """
+    Envía un POST a la API de Notion serializando el payload con orjson.
+    
+    Args:
+        path: Ruta relativa a NOTION_BASE_URL (ej: /v1/pages)
+        payload: Cuerpo de la petición
+        
+    Returns:
+        Respuesta HTTP de Notion
+    """
+    return await solicitar_notion("POST", path, content=orjson.dumps(payload), **kwargs)
+
+
+async def verificar_conexion_notion() -> None:
+    """
+    Autotest de arranque: abre la conexión con Notion y comprueba que se
+    negoció HTTP/2 (si no, las peticiones concurrentes no se multiplexan).
+    """
+    
+    if not NOTION_API_KEY:
+        return
+    
+    try:
+        response = await get_notion_client().get("/v1/users/me", timeout=5.0)
+        
+        if response.http_version != "HTTP/2":
+            logger.warning("La conexión con Notion usa %s en lugar de HTTP/2", response.http_version)
+        
+        if response.status_code != 200:
+            logger.warning("Autotest de Notion: respuesta %s", response.status_code)
+            
+    except httpx.RequestError as e:
+        logger.warning("Autotest de Notion: error de conexión: %s", e)
+
+
+def leer_json(response: httpx.Response) -> dict:
+    """
+    Parsea el cuerpo JSON de una respuesta de Notion con orjson.
+    """
+    return orjson.loads(response.content)
+
+
+def extraer_error_notion(response: httpx.Response, contexto: str) -> str:
+    """
+    Registra y resume una respuesta de error de Notion.
+    
+    Lee el cuerpo una sola vez, lo registra truncado a 500 caracteres y
+    solo lo parsea como JSON si el content-type lo indica, para quedarse
+    con el campo "message".
+    
+    Args:
+        response: Respuesta no exitosa de Notion
+        contexto: Descripción de la operación para el log
+        
+    Returns:
+        Mensaje de error legible
+    """
+    
+    texto = response.text
+    logger.error("%s: %s - %.500s", contexto, response.status_code, texto)
+    
+    if response.headers.get("content-type", "").startswith("application/json"):
+        try:
+            return orjson.loads(texto).get("message", "Error desconocido")
+        except (orjson.JSONDecodeError, AttributeError):
+            pass
+    
+    return texto[:500] or "Error desconocido"
+
+
+async def _sin_verificar() -> bool:
+    """Sustituto de verificar_ticket_existe cuando no se verifican duplicados."""
+    return False
 
 
 async def verificar_ticket_existe(ticket: int, identificador_cuenta: str) -> bool:
@@ -299,7 +910,7 @@ async def verificar_ticket_existe(ticket: int, identificador_cuenta: str) -> boo
     if not NOTION_API_KEY or not NOTION_DATABASE_ID:
         return False
     
-    query_url = f"{NOTION_QUERY_URL}/{NOTION_DATABASE_ID}/query"
+    query_url = f"{NOTION_DATABASES_PATH}/{NOTION_DATABASE_ID}/query"
     
     # Filtrar por ticket (ahora usamos rich_text ya que Title es Símbolo)
     payload = {
@@ -312,25 +923,19 @@ async def verificar_ticket_existe(ticket: int, identificador_cuenta: str) -> boo
         "page_size": 1
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                query_url,
-                headers=get_notion_headers(),
-                json=payload,
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return len(data.get("results", [])) > 0
-            else:
-                logger.warning(f"Error verificando ticket: {response.status_code}")
-                return False
-                
-        except httpx.RequestError as e:
-            logger.error(f"Error de conexión verificando ticket: {str(e)}")
+    try:
+        response = await notion_post(query_url, payload)
+        
+        if response.status_code == 200:
+            data = leer_json(response)
+            return len(data.get("results", [])) > 0
+        else:
+            extraer_error_notion(response, "Error verificando ticket")
             return False
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión verificando ticket: %s", e)
+        return False
 
 
 async def buscar_o_crear_cuenta(nombre_cuenta: str) -> str:
@@ -340,14 +945,93 @@ async def buscar_o_crear_cuenta(nombre_cuenta: str) -> str:
     """
     
     # Verificar cache primero
-    if nombre_cuenta in _cache_cuentas:
-        return _cache_cuentas[nombre_cuenta]
+    page_id = leer_cache(_cache_cuentas, nombre_cuenta)
+    if page_id is not None:
+        return page_id
     
     if not NOTION_CUENTAS_DB_ID:
         logger.warning("NOTION_CUENTAS_DB_ID no configurado, no se puede crear relación.")
         return ""
     
-    query_url = f"{NOTION_QUERY_URL}/{NOTION_CUENTAS_DB_ID}/query"
+    return await resolver_una_vez(
+        _en_curso_cuentas,
+        nombre_cuenta,
+        lambda: _resolver_cuenta(nombre_cuenta)
+    )
+
+
+async def buscar_cuenta(nombre_cuenta: str) -> str | None:
+    """
+    Devuelve el page_id de una cuenta sin crearla si no existe.
+    
+    Para consultas de solo lectura (/tickets): un identificador desconocido
+    o mal escrito no debe crear una página en la base de datos de Cuentas.
+    
+    Returns:
+        page_id de la cuenta, "" si no existe, o None si no se pudo consultar
+    """
+    
+    # Un "" cacheado es un fallo de resolución, no "no existe": se consulta
+    page_id = leer_cache(_cache_cuentas, nombre_cuenta)
+    if page_id:
+        return page_id
+    
+    if not NOTION_CUENTAS_DB_ID:
+        return None
+    
+    clave_disco = ("cuenta", NOTION_CUENTAS_DB_ID, nombre_cuenta)
+    page_id = await leer_cache_disco(clave_disco)
+    
+    if page_id is None:
+        page_id = await _consultar_cuenta_notion(nombre_cuenta)
+        
+        # Solo se cachean cuentas encontradas; "no existe" no se guarda para
+        # que buscar_o_crear_cuenta la cree cuando llegue su primer trade
+        if not page_id:
+            return page_id
+        
+        await guardar_cache_disco(clave_disco, page_id)
+    
+    guardar_cache(_cache_cuentas, nombre_cuenta, page_id)
+    return page_id
+
+
+async def _resolver_cuenta(nombre_cuenta: str) -> str:
+    """Resuelve el page_id de una cuenta (disco o Notion) y lo cachea."""
+    
+    clave_disco = ("cuenta", NOTION_CUENTAS_DB_ID, nombre_cuenta)
+    page_id = await leer_cache_disco(clave_disco)
+    
+    if page_id is None:
+        page_id = await _buscar_o_crear_cuenta_notion(nombre_cuenta)
+        if page_id:
+            await guardar_cache_disco(clave_disco, page_id)
+    
+    guardar_cache(_cache_cuentas, nombre_cuenta, page_id)
+    return page_id
+
+
+async def _buscar_o_crear_cuenta_notion(nombre_cuenta: str) -> str:
+    """Consulta la cuenta en Notion (sin cache) y la crea si no existe."""
+    
+    page_id = await _consultar_cuenta_notion(nombre_cuenta)
+    
+    if page_id is None:
+        return ""
+    
+    # "" = no existe, crear nueva
+    return page_id or await crear_cuenta(nombre_cuenta)
+
+
+async def _consultar_cuenta_notion(nombre_cuenta: str) -> str | None:
+    """
+    Busca la cuenta en Notion (sin cache y sin crearla).
+    
+    Returns:
+        page_id de la cuenta, "" si no existe, o None si la consulta falló
+    """
+    
+    query_url = f"{NOTION_DATABASES_PATH}/{NOTION_CUENTAS_DB_ID}/query"
     
     payload = {
         "filter": {
@@ -359,42 +1043,28 @@ async def buscar_o_crear_cuenta(nombre_cuenta: str) -> str:
         "page_size": 1
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                query_url,
-                headers=get_notion_headers(),
-                json=payload,
-                timeout=30.0
-            )
+    try:
+        response = await notion_post(query_url, payload)
+        
+        if response.status_code == 200:
+            data = leer_json(response)
+            results = data.get("results", [])
             
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get("results", [])
-                
-                if results:
-                    page_id = results[0]["id"]
-                    _cache_cuentas[nombre_cuenta] = page_id
-                    return page_id
-                else:
-                    # No existe, crear nueva
-                    return await crear_cuenta(nombre_cuenta)
-            else:
-                logger.error(f"Error buscando cuenta: {response.status_code}")
-                return ""
-                
-        except httpx.RequestError as e:
-            logger.error(f"Error de conexión buscando cuenta: {str(e)}")
-            return ""
+            return results[0]["id"] if results else ""
+        else:
+            extraer_error_notion(response, "Error buscando cuenta")
+            return None
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión buscando cuenta: %s", e)
+        return None
 
 
 async def crear_cuenta(nombre_cuenta: str) -> str:
     """Crea una nueva cuenta en la base de datos de Cuentas."""
     
     payload = {
-        "parent": {
-            "database_id": NOTION_CUENTAS_DB_ID
-        },
+        "parent": _PARENT_CUENTAS,
         "properties": {
             "Nombre": {
                 "title": [
@@ -408,27 +1078,20 @@ async def crear_cuenta(nombre_cuenta: str) -> str:
         }
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                NOTION_API_URL,
-                headers=get_notion_headers(),
-                json=payload,
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                page_id = response.json().get("id", "")
-                _cache_cuentas[nombre_cuenta] = page_id
-                logger.info(f"✓ Cuenta '{nombre_cuenta}' creada en Notion")
-                return page_id
-            else:
-                logger.error(f"Error creando cuenta: {response.status_code}")
-                return ""
-                
-        except httpx.RequestError as e:
-            logger.error(f"Error de conexión creando cuenta: {str(e)}")
+    try:
+        response = await notion_post(NOTION_PAGES_PATH, payload)
+        
+        if response.status_code == 200:
+            page_id = leer_json(response).get("id", "")
+            logger.info("✓ Cuenta '%s' creada en Notion", nombre_cuenta)
+            return page_id
+        else:
+            extraer_error_notion(response, "Error creando cuenta")
             return ""
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión creando cuenta: %s", e)
+        return ""
 
 
 async def buscar_o_crear_estrategia(magic_number: int) -> str:
@@ -437,14 +1100,40 @@ async def buscar_o_crear_estrategia(magic_number: int) -> str:
     Si no existe, la crea automáticamente.
     """
     
-    if magic_number in _cache_estrategias:
-        return _cache_estrategias[magic_number]
+    page_id = leer_cache(_cache_estrategias, magic_number)
+    if page_id is not None:
+        return page_id
     
     if not NOTION_ESTRATEGIAS_DB_ID:
         logger.warning("NOTION_ESTRATEGIAS_DB_ID no configurado, no se puede crear relación.")
         return ""
     
-    query_url = f"{NOTION_QUERY_URL}/{NOTION_ESTRATEGIAS_DB_ID}/query"
+    return await resolver_una_vez(
+        _en_curso_estrategias,
+        magic_number,
+        lambda: _resolver_estrategia(magic_number)
+    )
+
+
+async def _resolver_estrategia(magic_number: int) -> str:
+    """Resuelve el page_id de una estrategia (disco o Notion) y lo cachea."""
+    
+    clave_disco = ("estrategia", NOTION_ESTRATEGIAS_DB_ID, magic_number)
+    page_id = await leer_cache_disco(clave_disco)
+    
+    if page_id is None:
+        page_id = await _buscar_o_crear_estrategia_notion(magic_number)
+        if page_id:
+            await guardar_cache_disco(clave_disco, page_id)
+    
+    guardar_cache(_cache_estrategias, magic_number, page_id)
+    return page_id
+
+
+async def _buscar_o_crear_estrategia_notion(magic_number: int) -> str:
+    """Consulta la estrategia en Notion (sin cache) y la crea si no existe."""
+    
+    query_url = f"{NOTION_DATABASES_PATH}/{NOTION_ESTRATEGIAS_DB_ID}/query"
     
     payload = {
         "filter": {
@@ -456,32 +1145,24 @@ async def buscar_o_crear_estrategia(magic_number: int) -> str:
         "page_size": 1
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                query_url,
-                headers=get_notion_headers(),
-                json=payload,
-                timeout=30.0
-            )
+    try:
+        response = await notion_post(query_url, payload)
+        
+        if response.status_code == 200:
+            data = leer_json(response)
+            results = data.get("results", [])
             
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get("results", [])
-                
-                if results:
-                    page_id = results[0]["id"]
-                    _cache_estrategias[magic_number] = page_id
-                    return page_id
-                else:
-                    return await crear_estrategia(magic_number)
+            if results:
+                return results[0]["id"]
             else:
-                logger.error(f"Error buscando estrategia: {response.status_code}")
-                return ""
-                
-        except httpx.RequestError as e:
-            logger.error(f"Error de conexión buscando estrategia: {str(e)}")
+                return await crear_estrategia(magic_number)
+        else:
+            extraer_error_notion(response, "Error buscando estrategia")
             return ""
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión buscando estrategia: %s", e)
+        return ""
 
 
 async def crear_estrategia(magic_number: int) -> str:
@@ -490,9 +1171,7 @@ async def crear_estrategia(magic_number: int) -> str:
     nombre = f"Estrategia {magic_number}" if magic_number != 0 else "Manual (0)"
     
     payload = {
-        "parent": {
-            "database_id": NOTION_ESTRATEGIAS_DB_ID
-        },
+        "parent": _PARENT_ESTRATEGIAS,
         "properties": {
             "Nombre": {
                 "title": [
@@ -509,30 +1188,54 @@ async def crear_estrategia(magic_number: int) -> str:
         }
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                NOTION_API_URL,
-                headers=get_notion_headers(),
-                json=payload,
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                page_id = response.json().get("id", "")
-                _cache_estrategias[magic_number] = page_id
-                logger.info(f"✓ Estrategia '{nombre}' (Magic: {magic_number}) creada en Notion")
-                return page_id
-            else:
-                logger.error(f"Error creando estrategia: {response.status_code}")
-                return ""
-                
-        except httpx.RequestError as e:
-            logger.error(f"Error de conexión creando estrategia: {str(e)}")
+    try:
+        response = await notion_post(NOTION_PAGES_PATH, payload)
+        
+        if response.status_code == 200:
+            page_id = leer_json(response).get("id", "")
+            logger.info("✓ Estrategia '%s' (Magic: %s) creada en Notion", nombre, magic_number)
+            return page_id
+        else:
+            extraer_error_notion(response, "Error creando estrategia")
             return ""
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión creando estrategia: %s", e)
+        return ""
 
 
-async def obtener_tickets_cuenta(identificador_cuenta: str) -> list[int]:
+async def obtener_esquema(database_id: str) -> dict[str, str]:
+    """
+    Obtiene (y cachea) el mapeo nombre de propiedad -> id de una base de datos.
+    
+    Args:
+        database_id: ID de la base de datos de Notion
+        
+    Returns:
+        Diccionario {nombre: id}; vacío si no se pudo consultar
+    """
+    
+    if database_id in _esquemas_notion:
+        return _esquemas_notion[database_id]
+    
+    try:
+        response = await solicitar_notion("GET", f"{NOTION_DATABASES_PATH}/{database_id}")
+        
+        if response.status_code == 200:
+            propiedades = leer_json(response).get("properties", {})
+            esquema = {nombre: prop["id"] for nombre, prop in propiedades.items()}
+            _esquemas_notion[database_id] = esquema
+            return esquema
+        else:
+            extraer_error_notion(response, "Error obteniendo esquema de la base de datos")
+            return {}
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión obteniendo esquema: %s", e)
+        return {}
+
+
+async def obtener_tickets_cuenta(identificador_cuenta: str) -> list[int] | None:
     """
     Obtiene todos los tickets existentes para una cuenta específica.
     
@@ -540,114 +1243,170 @@ async def obtener_tickets_cuenta(identificador_cuenta: str) -> list[int]:
         identificador_cuenta: Identificador de la cuenta
         
     Returns:
-        Lista de tickets existentes
+        Lista de tickets existentes (vacía si la cuenta no existe), o None
+        si la consulta a Notion falló
     """
     
     if not NOTION_API_KEY or not NOTION_DATABASE_ID:
         return []
     
-    query_url = f"{NOTION_QUERY_URL}/{NOTION_DATABASE_ID}/query"
+    # Los trades se relacionan con la cuenta por su página en la base de
+    # datos de Cuentas, así que se filtra por la relación. Solo se busca:
+    # consultar tickets no debe crear la cuenta.
+    cuenta_page_id = await buscar_cuenta(identificador_cuenta)
+    
+    if cuenta_page_id is None:
+        logger.error("No se pudo resolver la cuenta '%s' para obtener sus tickets", identificador_cuenta)
+        return None
+    
+    if not cuenta_page_id:
+        return []
+    
+    # Pedir solo la propiedad Ticket reduce mucho el tamaño de la respuesta
+    id_ticket = (await obtener_esquema(NOTION_DATABASE_ID)).get("Ticket")
+    params = {"filter_properties": unquote(id_ticket)} if id_ticket else None
+    
+    query_url = f"{NOTION_DATABASES_PATH}/{NOTION_DATABASE_ID}/query"
     
+    # Productor/consumidor: el cursor de la página siguiente viene dentro de
+    # la respuesta, así que las peticiones son secuenciales; pero la
+    # extracción de tickets de la página N se hace mientras se espera la N+1.
     tickets = []
+    cola_paginas: asyncio.Queue = asyncio.Queue()
+    
+    async def extraer_tickets():
+        while (resultados := await cola_paginas.get()) is not None:
+            # Ticket es una propiedad numérica
+            for page in resultados:
+                ticket = page.get("properties", {}).get("Ticket", {}).get("number")
+                if ticket is not None:
+                    tickets.append(int(ticket))
+    
+    consumidor = asyncio.create_task(extraer_tickets())
+    
     has_more = True
     start_cursor = None
     
-    while has_more:
-        payload = {
-            "filter": {
-                "property": "Cuenta",
-                "select": {
-                    "equals": identificador_cuenta
-                }
-            },
-            "page_size": 100
-        }
-        
-        if start_cursor:
-            payload["start_cursor"] = start_cursor
-        
-        async with httpx.AsyncClient() as client:
+    try:
+        while has_more:
+            payload = {
+                "filter": {
+                    "property": "Cuenta",
+                    "relation": {
+                        "contains": cuenta_page_id
+                    }
+                },
+                "page_size": 100
+            }
+            
+            if start_cursor:
+                payload["start_cursor"] = start_cursor
+            
             try:
-                response = await client.post(
-                    query_url,
-                    headers=get_notion_headers(),
-                    json=payload,
-                    timeout=60.0
-                )
+                response = await notion_post(query_url, payload, params=params, timeout=60.0)
                 
                 if response.status_code == 200:
-                    data = response.json()
-                    
-                    # Extraer tickets de los resultados
-                    for page in data.get("results", []):
-                        props = page.get("properties", {})
-                        ticket_prop = props.get("Ticket", {})
-                        title_list = ticket_prop.get("title", [])
-                        
-                        if title_list:
-                            ticket_str = title_list[0].get("text", {}).get("content", "")
-                            if ticket_str.isdigit():
-                                tickets.append(int(ticket_str))
+                    data = leer_json(response)
+                    cola_paginas.put_nowait(data.get("results", []))
                     
                     has_more = data.get("has_more", False)
                     start_cursor = data.get("next_cursor")
                 else:
-                    logger.error(f"Error obteniendo tickets: {response.status_code}")
-                    has_more = False
+                    extraer_error_notion(response, "Error obteniendo tickets")
+                    return None
                     
             except httpx.RequestError as e:
-                logger.error(f"Error de conexión obteniendo tickets: {str(e)}")
-                has_more = False
+                logger.error("Error de conexión obteniendo tickets: %s", e)
+                return None
+    finally:
+        # Fin de páginas: el consumidor termina de vaciar la cola y sale
+        cola_paginas.put_nowait(None)
+        await consumidor
     
     return tickets
 
 
-async def enviar_a_notion(trade: TradeData, verificar_duplicado: bool = True) -> dict:
+async def precargar_tickets(identificador_cuenta: str) -> frozenset[int] | None:
     """
-    Envía los datos de una operación a la API de Notion.
+    Obtiene en una sola pasada los tickets existentes de una cuenta.
+    
+    Permite comprobar duplicados de un lote completo con un set en memoria
+    en lugar de una consulta a Notion por cada trade.
     
     Args:
-        trade: Datos de la operación de trading
-        verificar_duplicado: Si True, verifica que el ticket no exista antes de crear
+        identificador_cuenta: Identificador de la cuenta
         
     Returns:
-        Respuesta de la API de Notion
+        Set de tickets existentes, o None si no se pudieron obtener
+    """
+    
+    tickets = await obtener_tickets_cuenta(identificador_cuenta)
+    
+    if tickets is None:
+        return None
+    
+    return frozenset(tickets)
+
+
+async def obtener_tickets_cacheados(identificador_cuenta: str) -> list[int] | None:
+    """
+    obtener_tickets_cuenta con una cache de TICKETS_CACHE_TTL segundos.
+    
+    Las consultas concurrentes de una misma cuenta comparten una única
+    consulta a Notion.
+    
+    Args:
+        identificador_cuenta: Identificador de la cuenta
         
-    Raises:
-        HTTPException: Si hay error en la comunicación con Notion
+    Returns:
+        Lista de tickets existentes, o None si la consulta a Notion falló
     """
     
-    # Verificar configuración
-    if not NOTION_API_KEY or not NOTION_DATABASE_ID:
-        raise HTTPException(
-            status_code=500,
-            detail="Notion API Key o Database ID no configurados en el servidor."
-        )
+    tickets = leer_cache(_cache_tickets, identificador_cuenta)
     
-    # Verificar si ya existe (para evitar duplicados en sincronización)
-    if verificar_duplicado:
-        existe = await verificar_ticket_existe(trade.ticket, trade.identificador_cuenta)
-        if existe:
-            logger.info(f"Trade {trade.ticket} ya existe en Notion, omitiendo.")
-            return {
-                "id": "duplicate",
-                "status": "skipped",
-                "message": "El ticket ya existe en la base de datos"
-            }
+    if tickets is not None:
+        return tickets
+    
+    return await resolver_una_vez(
+        _en_curso_tickets,
+        identificador_cuenta,
+        lambda: _consultar_tickets(identificador_cuenta)
+    )
+
+
+async def _consultar_tickets(identificador_cuenta: str) -> list[int] | None:
+    """Consulta los tickets de una cuenta en Notion y cachea el resultado."""
+    
+    tickets = await obtener_tickets_cuenta(identificador_cuenta)
+    
+    if tickets is not None:
+        # Acotar la cache descartando la entrada más antigua
+        if len(_cache_tickets) >= TICKETS_CACHE_MAX and identificador_cuenta not in _cache_tickets:
+            del _cache_tickets[next(iter(_cache_tickets))]
+        _cache_tickets[identificador_cuenta] = (tickets, time.monotonic() + TICKETS_CACHE_TTL)
+    
+    return tickets
+
+
+def construir_payload_trade(trade: TradeData, cuenta_page_id: str, estrategia_page_id: str) -> dict:
+    """
+    Construye el payload de creación de página de Notion para un trade.
+    
+    Args:
+        trade: Datos de la operación de trading
+        cuenta_page_id: page_id de la cuenta relacionada ("" si no hay)
+        estrategia_page_id: page_id de la estrategia relacionada ("" si no hay)
+        
+    Returns:
+        Payload listo para enviar a /v1/pages
+    """
     
     # Formatear fechas
     fecha_cierre_iso = formatear_fecha_notion(trade.fecha_cierre)
     fecha_apertura_iso = formatear_fecha_notion(trade.fecha_apertura) if trade.fecha_apertura else None
     
-    # Buscar o crear las páginas de relación
-    cuenta_page_id = await buscar_o_crear_cuenta(trade.identificador_cuenta)
-    estrategia_page_id = await buscar_o_crear_estrategia(trade.magic_number)
-    
-    # Construir el payload para Notion
     payload = {
-        "parent": {
-            "database_id": NOTION_DATABASE_ID
-        },
+        "parent": _PARENT_TRADES,
         "properties": {
             # Título de la página: Símbolo (par de divisas)
             "Símbolo": {
@@ -742,44 +1501,96 @@ async def enviar_a_notion(trade: TradeData, verificar_duplicado: bool = True) ->
             }
         }
     
-    logger.info(f"Enviando trade a Notion: Ticket={trade.ticket}, Cuenta={trade.identificador_cuenta}")
+    return payload
+
+
+async def enviar_a_notion(
+    trade: TradeData,
+    verificar_duplicado: bool = True
+) -> dict:
+    """
+    Envía los datos de una operación a la API de Notion.
+    
+    Args:
+        trade: Datos de la operación de trading
+        verificar_duplicado: Si True, verifica que el ticket no exista antes de crear
+        
+    Returns:
+        Respuesta de la API de Notion
+        
+    Raises:
+        HTTPException: Si hay error en la comunicación con Notion
+    """
+    
+    # Verificar configuración
+    if not NOTION_API_KEY or not NOTION_DATABASE_ID:
+        raise HTTPException(
+            status_code=500,
+            detail="Notion API Key o Database ID no configurados en el servidor."
+        )
+    
+    # Verificar duplicado y resolver las páginas de relación en paralelo:
+    # son consultas independientes a Notion y así se paga un único RTT.
+    existe, cuenta_page_id, estrategia_page_id = await asyncio.gather(
+        verificar_ticket_existe(trade.ticket, trade.identificador_cuenta) if verificar_duplicado else _sin_verificar(),
+        buscar_o_crear_cuenta(trade.identificador_cuenta),
+        buscar_o_crear_estrategia(trade.magic_number)
+    )
+    
+    # Omitir si ya existe (para evitar duplicados en sincronización)
+    if existe:
+        logger.info("Trade %s ya existe en Notion, omitiendo.", trade.ticket)
+        return {
+            "id": "duplicate",
+            "status": "skipped",
+            "message": "El ticket ya existe en la base de datos"
+        }
+    
+    # Sin la relación con la cuenta el trade no aparecería en la precarga de
+    # tickets (filtra por esa relación) y se duplicaría en /sync: mejor
+    # fallar con un error reintentable que escribirlo sin ella
+    if NOTION_CUENTAS_DB_ID and not cuenta_page_id:
+        raise HTTPException(
+            status_code=503,
+            detail=f"No se pudo resolver la cuenta '{trade.identificador_cuenta}' en Notion"
+        )
+    
+    # Construir el payload para Notion
+    payload = construir_payload_trade(trade, cuenta_page_id, estrategia_page_id)
+    
+    logger.info("Enviando trade a Notion: Ticket=%s, Cuenta=%s", trade.ticket, trade.identificador_cuenta)
     
     # Realizar la petición a Notion
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                NOTION_API_URL,
-                headers=get_notion_headers(),
-                json=payload,
-                timeout=30.0
-            )
-            
-            # Verificar respuesta
-            if response.status_code == 200:
-                logger.info(f"✓ Trade {trade.ticket} registrado correctamente en Notion")
-                return response.json()
-            else:
-                error_detail = response.json()
-                logger.error(f"Error de Notion: {response.status_code} - {error_detail}")
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Error de Notion: {error_detail.get('message', 'Error desconocido')}"
-                )
-                
-        except httpx.RequestError as e:
-            logger.error(f"Error de conexión con Notion: {str(e)}")
+    try:
+        response = await notion_post(NOTION_PAGES_PATH, payload)
+        
+        # Verificar respuesta
+        if response.status_code == 200:
+            logger.info("✓ Trade %s registrado correctamente en Notion", trade.ticket)
+            # La lista de tickets cacheada de la cuenta ya no está completa
+            _cache_tickets.pop(trade.identificador_cuenta, None)
+            return leer_json(response)
+        else:
+            mensaje = extraer_error_notion(response, "Error de Notion")
             raise HTTPException(
-                status_code=503,
-                detail=f"Error de conexión con Notion: {str(e)}"
+                status_code=response.status_code,
+                detail=f"Error de Notion: {mensaje}"
             )
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión con Notion: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail=f"Error de conexión con Notion: {str(e)}"
+        )
 
 
 async def guardar_drawdown_notion(drawdown: DrawdownData) -> dict:
     """
     Guarda los datos de drawdown en Notion.
     
-    Si NOTION_DRAWDOWN_DB_ID está configurado, usa esa base de datos.
-    De lo contrario, no guarda (solo loguea).
+    Según _MODO_DRAWDOWN lo guarda en NOTION_DRAWDOWN_DB_ID o solo lo
+    registra en los logs.
     
     Args:
         drawdown: Datos de drawdown
@@ -788,28 +1599,28 @@ async def guardar_drawdown_notion(drawdown: DrawdownData) -> dict:
         Respuesta de la API de Notion
     """
     
-    db_id = NOTION_DRAWDOWN_DB_ID or NOTION_DATABASE_ID
-    
-    if not NOTION_API_KEY or not db_id:
-        logger.info(f"Drawdown recibido pero no hay DB configurada para guardarlo: "
-                   f"Cuenta={drawdown.identificador_cuenta}, DD Cuenta={drawdown.drawdown_cuenta}")
-        return {"status": "logged_only", "message": "No hay base de datos de drawdown configurada"}
-    
-    # Si no hay base de datos de drawdown específica, solo logueamos
-    if not NOTION_DRAWDOWN_DB_ID:
-        logger.info(f"📊 Drawdown - Cuenta: {drawdown.identificador_cuenta}, "
-                   f"Magic: {drawdown.magic_number}, "
-                   f"DD Cuenta: ${drawdown.drawdown_cuenta:.2f} ({drawdown.drawdown_cuenta_pct:.2f}%), "
-                   f"DD Estrategia: ${drawdown.drawdown_estrategia:.2f}")
-        return {"status": "logged", "message": "Drawdown registrado en logs"}
-    
-    # Si hay base de datos de drawdown, guardar
+    match _MODO_DRAWDOWN:
+        case "disabled":
+            logger.info("Drawdown recibido pero no hay DB configurada para guardarlo: "
+                        "Cuenta=%s, DD Cuenta=%s",
+                        drawdown.identificador_cuenta, drawdown.drawdown_cuenta)
+            return {"status": "logged_only", "message": "No hay base de datos de drawdown configurada"}
+        
+        case "logged":
+            # Se llama en cada tick de drawdown: no formatear si INFO está filtrado
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("📊 Drawdown - Cuenta: %s, Magic: %s, "
+                            "DD Cuenta: $%.2f (%.2f%%), DD Estrategia: $%.2f",
+                            drawdown.identificador_cuenta, drawdown.magic_number,
+                            drawdown.drawdown_cuenta, drawdown.drawdown_cuenta_pct,
+                            drawdown.drawdown_estrategia)
+            return {"status": "logged", "message": "Drawdown registrado en logs"}
+    
+    # Modo "notion": guardar en la base de datos de drawdown
     fecha_iso = formatear_fecha_notion(drawdown.timestamp)
     
     payload = {
-        "parent": {
-            "database_id": NOTION_DRAWDOWN_DB_ID
-        },
+        "parent": _PARENT_DRAWDOWN,
         "properties": {
             "Timestamp": {
                 "title": [
@@ -855,45 +1666,472 @@ async def guardar_drawdown_notion(drawdown: DrawdownData) -> dict:
         }
     }
     
-    async with httpx.AsyncClient() as client:
+    try:
+        response = await notion_post(NOTION_PAGES_PATH, payload)
+        
+        if response.status_code == 200:
+            logger.info("✓ Drawdown guardado: Cuenta=%s", drawdown.identificador_cuenta)
+            return leer_json(response)
+        else:
+            mensaje = extraer_error_notion(response, "Error guardando drawdown")
+            return {"status": "error", "detail": mensaje}
+            
+    except httpx.RequestError as e:
+        logger.error("Error de conexión guardando drawdown: %s", e)
+        return {"status": "error", "detail": str(e)}
+
+
+def trozos(elementos: list, tamano: int):
+    """
+    Divide una lista en trozos de como mucho `tamano` elementos
+    (itertools.batched no existe en Python 3.10, el de PythonAnywhere).
+    """
+    
+    iterador = iter(elementos)
+    
+    while trozo := list(islice(iterador, tamano)):
+        yield trozo
+
+
+async def preparar_lote_trades(
+    trades: list[TradeData],
+    precargar: bool = True
+) -> tuple[list[dict], list[tuple[TradeData, bool]]]:
+    """
+    Separa un lote en trades ya existentes y trades a enviar a Notion.
+    
+    Args:
+        trades: Lista de operaciones a registrar
+        precargar: Si False, no se precargan los tickets de las cuentas y
+            cada trade se verifica individualmente en Notion
+        
+    Returns:
+        (omitidos, pendientes): detalle de los omitidos y, para el resto,
+        tuplas (trade, verificar_duplicado)
+    """
+    
+    omitidos = []
+    
+    # Agrupar por cuenta. Un ticket repetido dentro del mismo lote se envía
+    # una sola vez (al procesarse en paralelo, la verificación en Notion no
+    # lo detectaría)
+    trades_por_cuenta: defaultdict[str, list[TradeData]] = defaultdict(list)
+    tickets_lote = set()
+    
+    for trade in trades:
+        if trade.ticket in tickets_lote:
+            omitidos.append({
+                "ticket": trade.ticket,
+                "status": "skipped",
+                "message": "Ya existe"
+            })
+        else:
+            tickets_lote.add(trade.ticket)
+            trades_por_cuenta[trade.identificador_cuenta].append(trade)
+    
+    # Precargar una sola vez los tickets existentes de las cuentas con varios
+    # trades en el lote; si la precarga falla (o la cuenta tiene un único
+    # trade), ese trade se verifica individualmente en Notion.
+    cuentas = [
+        cuenta for cuenta, lista in trades_por_cuenta.items()
+        if precargar and len(lista) > 1
+    ]
+    precargados = await asyncio.gather(*(precargar_tickets(cuenta) for cuenta in cuentas))
+    tickets_por_cuenta = dict(zip(cuentas, precargados))
+    
+    # Los tickets ya existentes se omiten aquí, sin lanzar ninguna tarea;
+    # el resto se envía sin volver a verificar.
+    pendientes: list[tuple[TradeData, bool]] = []
+    
+    for cuenta, trades_cuenta in trades_por_cuenta.items():
+        existentes = tickets_por_cuenta.get(cuenta)
+        
+        if existentes is None:
+            pendientes.extend((trade, True) for trade in trades_cuenta)
+            continue
+        
+        for trade in trades_cuenta:
+            if trade.ticket in existentes:
+                omitidos.append({
+                    "ticket": trade.ticket,
+                    "status": "skipped",
+                    "message": "Ya existe"
+                })
+            else:
+                pendientes.append((trade, False))
+    
+    return omitidos, pendientes
+
+
+async def enviar_trade_etiquetado(
+    trade: TradeData,
+    verificar: bool,
+    semaforo: asyncio.Semaphore
+) -> tuple[str, dict]:
+    """
+    Envía un trade de un lote y devuelve (estado, detalle) ya etiquetado.
+    
+    El estado es "ok", "skipped" o "error"; el semáforo limita los trades
+    en vuelo para respetar el rate limit de Notion. Cualquier fallo de un
+    trade se devuelve como "error" sin abortar el resto del lote.
+    """
+    
+    async with semaforo:
+        try:
+            resultado = await enviar_a_notion(trade, verificar_duplicado=verificar)
+        except Exception as e:
+            if not isinstance(e, HTTPException):
+                logger.exception("Error inesperado enviando el trade %s", trade.ticket)
+            return "error", {
+                "ticket": trade.ticket,
+                "status": "error",
+                "status_code": getattr(e, "status_code", 500),
+                "detail": str(getattr(e, "detail", e))
+            }
+    
+    if resultado.get("status") == "skipped":
+        return "skipped", {
+            "ticket": trade.ticket,
+            "status": "skipped",
+            "message": "Ya existe"
+        }
+    
+    return "ok", {
+        "ticket": trade.ticket,
+        "status": "success",
+        "page_id": resultado.get("id", "")
+    }
+
+
+async def procesar_lote_trades(
+    trades: list[TradeData],
+    max_concurrentes: int = MAX_TRADES_CONCURRENTES,
+    precargar: bool = True
+) -> dict:
+    """
+    Envía un lote de trades a Notion en paralelo, omitiendo duplicados.
+    
+    Args:
+        trades: Lista de operaciones a registrar
+        max_concurrentes: Máximo de trades enviándose a la vez
+        precargar: Precargar los tickets de cada cuenta (ver preparar_lote_trades)
+        
+    Returns:
+        Resumen del registro (exitosos, omitidos y errores)
+    """
+    
+    omitidos, pendientes = await preparar_lote_trades(trades, precargar)
+    resultados = []
+    errores = []
+    
+    semaforo = asyncio.Semaphore(max_concurrentes)
+    destinos = {"ok": resultados, "skipped": omitidos, "error": errores}
+    
+    # Por tandas de TAMANO_TROZO_LOTE para no crear miles de corrutinas a la vez
+    for trozo in trozos(pendientes, TAMANO_TROZO_LOTE):
+        # enviar_trade_etiquetado no lanza: cada fallo llega como "error"
+        respuestas = await asyncio.gather(
+            *(enviar_trade_etiquetado(trade, verificar, semaforo) for trade, verificar in trozo)
+        )
+        
+        # Repartir los resultados etiquetados en una sola pasada
+        for estado, detalle in respuestas:
+            destinos[estado].append(detalle)
+    
+    return {
+        "total_recibidos": len(trades),
+        "exitosos": len(resultados),
+        "omitidos": len(omitidos),
+        "fallidos": len(errores),
+        "resultados": resultados,
+        "omitidos_detalle": omitidos,
+        "errores": errores
+    }
+
+
+async def transmitir_lote_trades(
+    trades: list[TradeData],
+    max_concurrentes: int = MAX_TRADES_CONCURRENTES
+):
+    """
+    Igual que procesar_lote_trades, pero genera una línea NDJSON por trade
+    en cuanto termina y, al final, una línea con el resumen.
+    
+    El cliente ve el progreso desde el primer trade y el servidor no
+    acumula el detalle de todo el lote en memoria.
+    
+    Args:
+        trades: Lista de operaciones a registrar
+        max_concurrentes: Máximo de trades enviándose a la vez
+        
+    Yields:
+        Líneas JSON (bytes terminados en salto de línea)
+    """
+    
+    omitidos, pendientes = await preparar_lote_trades(trades)
+    contadores = {"ok": 0, "skipped": len(omitidos), "error": 0}
+    
+    for detalle in omitidos:
+        yield orjson.dumps(detalle) + b"\n"
+    
+    semaforo = asyncio.Semaphore(max_concurrentes)
+    
+    for trozo in trozos(pendientes, TAMANO_TROZO_LOTE):
+        tareas = [
+            asyncio.create_task(enviar_trade_etiquetado(trade, verificar, semaforo))
+            for trade, verificar in trozo
+        ]
+        
+        try:
+            for siguiente in asyncio.as_completed(tareas):
+                estado, detalle = await siguiente
+                contadores[estado] += 1
+                yield orjson.dumps(detalle) + b"\n"
+        finally:
+            # Si el cliente se desconecta, no dejar trades en vuelo huérfanos
+            for tarea in tareas:
+                tarea.cancel()
+    
+    yield orjson.dumps({
+        "status": "summary",
+        "total_recibidos": len(trades),
+        "exitosos": contadores["ok"],
+        "omitidos": contadores["skipped"],
+        "fallidos": contadores["error"]
+    }) + b"\n"
+
+
+def es_error_reintentable(status_code: int) -> bool:
+    """
+    Indica si un fallo es transitorio: rate limit (429), errores de Notion
+    (5xx) o de conexión (503). El resto de 4xx (validation_error, esquema
+    que no encaja...) fallaría igual en cada reintento.
+    """
+    
+    return status_code == 429 or status_code >= 500
+
+
+def programar_reintento(trade: TradeData) -> None:
+    """
+    Vuelve a encolar un trade fallido tras una espera exponencial
+    (ESPERA_BASE_REINTENTO, el doble en cada intento, hasta ESPERA_MAX_REINTENTO).
+    
+    Tras REINTENTOS_MAX_WORKER intentos se deja de reintentar; el trade
+    sigue en el diario y se reenvía en el próximo arranque.
+    """
+    
+    intento = _reintentos_trades.get(trade.ticket, 0) + 1
+    
+    if intento > REINTENTOS_MAX_WORKER:
+        _reintentos_trades.pop(trade.ticket, None)
+        logger.error("Trade %s sin registrar tras %s intentos; queda en el diario "
+                     "para el próximo arranque", trade.ticket, REINTENTOS_MAX_WORKER)
+        return
+    
+    _reintentos_trades[trade.ticket] = intento
+    espera = min(ESPERA_BASE_REINTENTO * 2 ** (intento - 1), ESPERA_MAX_REINTENTO)
+    
+    logger.warning("Reintento %s del trade %s en %.0f s", intento, trade.ticket, espera)
+    
+    tarea = asyncio.create_task(reencolar_trade(trade, espera))
+    _tareas_reintento.add(tarea)
+    tarea.add_done_callback(_tareas_reintento.discard)
+
+
+async def reencolar_trade(trade: TradeData, espera: float) -> None:
+    """
+    Espera y vuelve a poner un trade en la cola del worker.
+    """
+    
+    await asyncio.sleep(espera)
+    
+    if _cola_trades is not None:
+        await _cola_trades.put(trade)
+
+
+async def procesar_cola_trades(cola: asyncio.Queue):
+    """
+    Worker que vacía la cola de trades en tiempo real hacia Notion.
+    
+    Espera al primer trade y recoge los que lleguen durante los siguientes
+    VENTANA_LOTE_WORKER segundos, hasta TRADES_POR_LOTE_WORKER, enviándolos
+    como un solo lote.
+    """
+    
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        lote = [await cola.get()]
+        limite = loop.time() + VENTANA_LOTE_WORKER
+        
+        while len(lote) < TRADES_POR_LOTE_WORKER:
+            restante = limite - loop.time()
+            if restante <= 0:
+                break
+            
+            # asyncio.wait en lugar de wait_for: al expirar, el get se cancela
+            # sin riesgo de perder un trade ya sacado de la cola
+            siguiente = asyncio.ensure_future(cola.get())
+            hecho, _ = await asyncio.wait({siguiente}, timeout=restante)
+            
+            if not hecho:
+                siguiente.cancel()
+                break
+            
+            lote.append(siguiente.result())
+        
         try:
-            response = await client.post(
-                NOTION_API_URL,
-                headers=get_notion_headers(),
-                json=payload,
-                timeout=30.0
+            # Sin precarga: para unos pocos trades en tiempo real, recorrer el
+            # historial completo de la cuenta cuesta mucho más que verificar
+            # cada ticket por separado
+            resumen = await procesar_lote_trades(
+                lote, MAX_TRADES_CONCURRENTES_WORKER, precargar=False
             )
             
-            if response.status_code == 200:
-                logger.info(f"✓ Drawdown guardado: Cuenta={drawdown.identificador_cuenta}")
-                return response.json()
-            else:
-                error_detail = response.json()
-                logger.error(f"Error guardando drawdown: {response.status_code}")
-                return {"status": "error", "detail": str(error_detail)}
+            for error in resumen["errores"]:
+                logger.error("Error registrando trade %s: %s", error["ticket"], error["detail"])
+            
+            # Los registrados u omitidos (ya existían) salen del diario; los
+            # fallidos por un error transitorio siguen en él y se reencolan
+            # con backoff. Los rechazados por Notion también salen: se
+            # rechazarían igual en cada reintento y en cada arranque.
+            fallidos = {
+                error["ticket"] for error in resumen["errores"]
+                if es_error_reintentable(error["status_code"])
+            }
+            rechazados = {error["ticket"] for error in resumen["errores"]} - fallidos
+            confirmados = [
+                detalle["ticket"]
+                for detalle in resumen["resultados"] + resumen["omitidos_detalle"] + resumen["errores"]
+                if detalle["ticket"] not in fallidos
+            ]
+            
+            for ticket in confirmados:
+                _reintentos_trades.pop(ticket, None)
+            
+            await confirmar_pendientes(confirmados)
+            
+            for trade in lote:
+                if trade.ticket in fallidos:
+                    programar_reintento(trade)
+                elif trade.ticket in rechazados:
+                    # Se registra completo para poder reenviarlo a mano
+                    logger.error("Trade %s rechazado por Notion, descartado del diario: %s",
+                                 trade.ticket, trade.model_dump_json())
                 
-        except httpx.RequestError as e:
-            logger.error(f"Error de conexión guardando drawdown: {str(e)}")
-            return {"status": "error", "detail": str(e)}
+        except Exception as e:
+            logger.error("Error procesando lote de %s trades: %s", len(lote), e)
+            
+            for trade in lote:
+                programar_reintento(trade)
+            
+        finally:
+            for _ in lote:
+                cola.task_done()
+
+
+# =============================================================================
+#                           CICLO DE VIDA
+# =============================================================================
+
+async def iniciar_cliente_notion():
+    """
+    Crea el cliente HTTP compartido y el worker de trades al arrancar el servidor.
+    """
+    global _cola_trades, _worker_trades
+    
+    get_notion_client()
+    await verificar_conexion_notion()
+    
+    _cola_trades = asyncio.Queue(maxsize=TAMANO_COLA_TRADES)
+    _worker_trades = asyncio.create_task(procesar_cola_trades(_cola_trades))
+    
+    # Reencolar los trades que quedaron sin enviar antes del último reinicio
+    # (si no caben en la cola siguen en el diario para el próximo arranque)
+    pendientes = await cargar_pendientes()
+    
+    for trade in pendientes[:TAMANO_COLA_TRADES]:
+        _cola_trades.put_nowait(trade)
+    
+    if pendientes:
+        logger.info("Reencolados %s trades pendientes de una ejecución anterior",
+                    min(len(pendientes), TAMANO_COLA_TRADES))
+
+
+async def precargar_esquema_trades() -> None:
+    """
+    Consulta al arrancar el esquema de la base de datos de trades (de él sale
+    el id de Ticket para filter_properties), para no pagar esa consulta en la
+    primera sincronización.
+    
+    Queda en la cache de obtener_esquema; si falla se reintenta cuando se
+    necesite.
+    """
+    
+    if not NOTION_API_KEY or not NOTION_DATABASE_ID:
+        return
+    
+    propiedades = await obtener_esquema(NOTION_DATABASE_ID)
+    
+    logger.info("Esquema de trades precargado: %s propiedades", len(propiedades))
+
+
+async def cerrar_cliente_notion():
+    """
+    Vacía la cola de trades y cierra las conexiones con Notion al detener el servidor.
+    """
+    global _client, _cola_trades, _worker_trades
+    
+    if _worker_trades is not None:
+        try:
+            await asyncio.wait_for(_cola_trades.join(), timeout=10.0)
+        except asyncio.TimeoutError:
+            logger.warning("Se detiene el servidor con %s trades sin enviar a Notion", _cola_trades.qsize())
+        
+        _worker_trades.cancel()
+        _worker_trades = None
+        _cola_trades = None
+    
+    # Los reintentos pendientes siguen en el diario para el próximo arranque
+    for tarea in list(_tareas_reintento):
+        tarea.cancel()
+    _reintentos_trades.clear()
+    
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    
+    if _cache_disco is not None:
+        _cache_disco.close()
 
 
 # =============================================================================
 #                           ENDPOINTS
 # =============================================================================
 
+# La respuesta de "/" solo depende de la configuración: se serializa una vez
+_RESPUESTA_RAIZ = orjson.dumps({
+    "status": "online",
+    "service": "MT4 Trade Logger",
+    "version": "2.0.0",
+    "notion_configured": bool(NOTION_API_KEY and NOTION_DATABASE_ID),
+    "drawdown_db_configured": bool(NOTION_DRAWDOWN_DB_ID)
+})
+
+
 @app.get("/")
 async def root():
     """
     Endpoint raíz para verificar que el servidor está activo.
     """
     
-    return {
-        "status": "online",
-        "service": "MT4 Trade Logger",
-        "version": "2.0.0",
-        "notion_configured": bool(NOTION_API_KEY and NOTION_DATABASE_ID),
-        "drawdown_db_configured": bool(NOTION_DRAWDOWN_DB_ID)
-    }
+    return Response(content=_RESPUESTA_RAIZ, media_type="application/json")
+
+
+# Cuerpo de /health cacheado por segundo: los balanceadores lo consultan
+# varias veces por segundo y no necesitan más resolución en el timestamp
+_health_segundo = 0
+_health_cuerpo = b""
 
 
 @app.get("/health")
@@ -901,11 +2139,18 @@ async def health_check():
     """
     Endpoint de health check para monitoreo.
     """
+    global _health_segundo, _health_cuerpo
     
-    return {
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat()
-    }
+    ahora = int(time.time())
+    
+    if ahora != _health_segundo:
+        _health_cuerpo = orjson.dumps({
+            "status": "healthy",
+            "timestamp": datetime.fromtimestamp(ahora).isoformat()
+        })
+        _health_segundo = ahora
+    
+    return Response(content=_health_cuerpo, media_type="application/json")
 
 
 @app.get("/tickets/{identificador_cuenta}")
@@ -922,11 +2167,11 @@ async def obtener_tickets(identificador_cuenta: str):
         Lista de tickets existentes
     """
     
-    logger.info(f"Solicitando tickets para cuenta: {identificador_cuenta}")
+    logger.info("Solicitando tickets para cuenta: %s", identificador_cuenta)
     
-    tickets = await obtener_tickets_cuenta(identificador_cuenta)
+    tickets = await obtener_tickets_cacheados(identificador_cuenta) or []
     
-    logger.info(f"Retornando {len(tickets)} tickets para {identificador_cuenta}")
+    logger.info("Retornando %s tickets para %s", len(tickets), identificador_cuenta)
     
     return {
         "cuenta": identificador_cuenta,
@@ -935,23 +2180,58 @@ async def obtener_tickets(identificador_cuenta: str):
     }
 
 
-@app.post("/trade")
-async def registrar_trade(trade: TradeData):
+# Acuse de /trade construido directamente en bytes: el ticket es un int ya
+# validado, así que basta con concatenarlo
+_ACEPTADO_PREFIJO = b'{"accepted":true,"ticket":'
+
+
+@app.post("/trade", status_code=202)
+async def registrar_trade(trade: TradeData, wait: bool = False):
     """
     Endpoint principal para recibir y registrar operaciones de trading.
     
-    Verifica automáticamente si el trade ya existe para evitar duplicados.
+    El trade se anota en el diario de pendientes y se encola; un worker en
+    segundo plano lo envía a Notion, de modo que la latencia de Notion no
+    afecta al EA (202 Accepted). El worker verifica automáticamente si el
+    trade ya existe para evitar duplicados.
+    
+    Con `?wait=1` se envía a Notion antes de responder, como confirmación.
+    Si la app se sirve sin lifespan (no hay cola ni worker), siempre se
+    registra así.
     
     Args:
         trade: Datos de la operación (ver modelo TradeData)
+        wait: Si True, esperar al registro en Notion
         
     Returns:
-        Confirmación del registro
+        Acuse de recibo, o el resultado del registro si wait=True
     """
     
-    logger.info(f"Recibida operación: Cuenta={trade.identificador_cuenta}, "
-                f"Ticket={trade.ticket}, Símbolo={trade.simbolo}, "
-                f"PnL={trade.pnl}, Resultado={trade.resultado}")
+    logger.info("Recibida operación: Cuenta=%s, Ticket=%s, Símbolo=%s, PnL=%s, Resultado=%s",
+                trade.identificador_cuenta, trade.ticket, trade.simbolo,
+                trade.pnl, trade.resultado)
+    
+    if wait or _cola_trades is None:
+        return RespuestaORJSON(content=await registrar_trade_sincrono(trade))
+    
+    # Encolar para el worker de Notion (espera si la cola está llena) y
+    # anotarlo en el diario. El diario escribe en un único hilo en orden,
+    # así que esta anotación siempre llega antes que la confirmación
+    # del worker.
+    await _cola_trades.put(trade)
+    await guardar_pendiente(trade)
+    
+    return Response(
+        content=_ACEPTADO_PREFIJO + str(trade.ticket).encode() + b"}",
+        status_code=202,
+        media_type="application/json"
+    )
+
+
+async def registrar_trade_sincrono(trade: TradeData) -> dict:
+    """
+    Registra un trade en Notion esperando la respuesta (/trade?wait=1).
+    """
     
     # Enviar a Notion (con verificación de duplicados)
     resultado_notion = await enviar_a_notion(trade, verificar_duplicado=True)
@@ -973,58 +2253,118 @@ async def registrar_trade(trade: TradeData):
     }
 
 
-@app.post("/trade/batch")
-async def registrar_trades_batch(trades: list[TradeData]):
+def quiere_ndjson(request: Request) -> bool:
+    """
+    Indica si el cliente pidió el resultado en streaming (NDJSON), con
+    `?stream=1` o con `Accept: application/x-ndjson`.
+    """
+    
+    return (
+        request.query_params.get("stream") == "1"
+        or "application/x-ndjson" in request.headers.get("accept", "")
+    )
+
+
+async def responder_lote(trades: list[TradeData], request: Request):
+    """
+    Procesa un lote ya validado y construye la respuesta: NDJSON en
+    streaming si el cliente lo pidió (ver quiere_ndjson), o el resumen JSON.
+    """
+    
+    if quiere_ndjson(request):
+        return StreamingResponse(
+            transmitir_lote_trades(trades),
+            media_type="application/x-ndjson"
+        )
+    
+    # Respuesta explícita: el resumen va directo a orjson, sin jsonable_encoder
+    return RespuestaORJSON(content=await procesar_lote_trades(trades))
+
+
+async def leer_lote_trades(request: Request) -> list[TradeData]:
+    """
+    Lee y valida el cuerpo de un lote de trades fuera del event loop.
+    
+    Raises:
+        HTTPException: 413 si el cuerpo supera TAMANO_MAX_CUERPO_LOTE bytes
+            o MAX_TRADES_POR_LOTE trades
+    """
+    
+    demasiado_grande = HTTPException(
+        status_code=413,
+        detail=f"El cuerpo supera el máximo de {TAMANO_MAX_CUERPO_LOTE} bytes"
+    )
+    
+    # Rechazar por Content-Length antes de leer nada del cuerpo
+    longitud = request.headers.get("content-length", "")
+    
+    if longitud.isdigit() and int(longitud) > TAMANO_MAX_CUERPO_LOTE:
+        raise demasiado_grande
+    
+    # Leer por partes llevando la cuenta: un cuerpo sin Content-Length
+    # (chunked) se corta en cuanto pasa del límite, sin acumularlo entero
+    partes = []
+    leido = 0
+    
+    async for parte in request.stream():
+        leido += len(parte)
+        if leido > TAMANO_MAX_CUERPO_LOTE:
+            raise demasiado_grande
+        partes.append(parte)
+    
+    cuerpo = b"".join(partes)
+    
+    trades = await asyncio.get_running_loop().run_in_executor(
+        _executor_validacion, parsear_trades_bulk, cuerpo
+    )
+    
+    if len(trades) > MAX_TRADES_POR_LOTE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Máximo {MAX_TRADES_POR_LOTE} trades por petición (recibidos {len(trades)})"
+        )
+    
+    return trades
+
+
+# El cuerpo de los lotes se valida a mano (parsear_trades_bulk), así que su
+# esquema se declara aquí para que siga apareciendo en la documentación
+_OPENAPI_LOTE_TRADES = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {
+                    "type": "array",
+                    "items": {"$ref": "#/components/schemas/TradeData"}
+                }
+            }
+        }
+    }
+}
+
+
+@app.post("/trade/batch", response_model=None, openapi_extra=_OPENAPI_LOTE_TRADES)
+async def registrar_trades_batch(request: Request):
     """
     Endpoint para registrar múltiples operaciones a la vez.
     
     Útil para sincronización inicial o recuperación de histórico.
     Verifica duplicados automáticamente.
     
+    Con `?stream=1` o `Accept: application/x-ndjson` responde en NDJSON:
+    una línea por trade según termina y una línea final de resumen.
+    
     Args:
-        trades: Lista de operaciones a registrar
+        request: Petición cuyo cuerpo es la lista de trades a registrar
         
     Returns:
         Resumen del registro
     """
     
-    resultados = []
-    errores = []
-    omitidos = []
+    trades = await leer_lote_trades(request)
     
-    for trade in trades:
-        try:
-            resultado = await enviar_a_notion(trade, verificar_duplicado=True)
-            
-            if resultado.get("status") == "skipped":
-                omitidos.append({
-                    "ticket": trade.ticket,
-                    "status": "skipped",
-                    "message": "Ya existe"
-                })
-            else:
-                resultados.append({
-                    "ticket": trade.ticket,
-                    "status": "success",
-                    "page_id": resultado.get("id", "")
-                })
-                
-        except HTTPException as e:
-            errores.append({
-                "ticket": trade.ticket,
-                "status": "error",
-                "detail": str(e.detail)
-            })
-    
-    return {
-        "total_recibidos": len(trades),
-        "exitosos": len(resultados),
-        "omitidos": len(omitidos),
-        "fallidos": len(errores),
-        "resultados": resultados,
-        "omitidos_detalle": omitidos,
-        "errores": errores
-    }
+    return await responder_lote(trades, request)
 
 
 @app.post("/drawdown")
@@ -1041,10 +2381,13 @@ async def registrar_drawdown(drawdown: DrawdownData):
         Confirmación del registro
     """
     
-    logger.info(f"📊 Drawdown recibido: Cuenta={drawdown.identificador_cuenta}, "
-                f"Magic={drawdown.magic_number}, "
-                f"DD Cuenta=${drawdown.drawdown_cuenta:.2f} ({drawdown.drawdown_cuenta_pct:.2f}%), "
-                f"DD Estrategia=${drawdown.drawdown_estrategia:.2f}")
+    # Llega con cada tick de drawdown: no formatear si INFO está filtrado
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("📊 Drawdown recibido: Cuenta=%s, Magic=%s, "
+                    "DD Cuenta=$%.2f (%.2f%%), DD Estrategia=$%.2f",
+                    drawdown.identificador_cuenta, drawdown.magic_number,
+                    drawdown.drawdown_cuenta, drawdown.drawdown_cuenta_pct,
+                    drawdown.drawdown_estrategia)
     
     # Guardar en Notion (si está configurado)
     resultado = await guardar_drawdown_notion(drawdown)
@@ -1060,43 +2403,67 @@ async def registrar_drawdown(drawdown: DrawdownData):
     }
 
 
-@app.post("/sync")
-async def sincronizar_historial(trades: list[TradeData]):
+@app.post("/sync", response_model=None, openapi_extra=_OPENAPI_LOTE_TRADES)
+async def sincronizar_historial(request: Request):
     """
     Endpoint específico para sincronización de historial.
     
-    Similar a /trade/batch pero optimizado para sincronización masiva.
+    Equivalente a /trade/batch; es el que usa el EA para la sincronización
+    masiva. Como allí, el cuerpo (lista de TradeData) se valida en un hilo
+    aparte para no bloquear el event loop con listas grandes.
     
     Args:
-        trades: Lista de trades históricos
+        request: Petición cuyo cuerpo es la lista de trades históricos
         
     Returns:
         Resumen de la sincronización
     """
     
-    logger.info(f"Iniciando sincronización de {len(trades)} trades")
+    trades = await leer_lote_trades(request)
+    
+    logger.info("Iniciando sincronización de %s trades", len(trades))
     
-    # Usar el endpoint batch
-    return await registrar_trades_batch(trades)
+    return await responder_lote(trades, request)
 
 
 # =============================================================================
 #                           MANEJO DE ERRORES
 # =============================================================================
 
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    """
+    Errores HTTP esperados (Notion caído, ruta inexistente...): se conserva
+    su código de estado y se responde con orjson.
+    """
+    
+    return RespuestaORJSON(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers=exc.headers
+    )
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """
-    Manejador global de excepciones para logging.
+    Manejador global de excepciones: registra la traza en el servidor y
+    responde 500 al cliente.
+    
+    asyncio.CancelledError (cliente desconectado) hereda de BaseException,
+    así que nunca llega aquí ni ensucia los logs.
     """
     
-    logger.error(f"Error no manejado: {str(exc)}")
+    logger.exception("Error no manejado en %s: %s", request.url.path, exc)
     
-    return {
-        "success": False,
-        "error": str(exc),
-        "path": request.url.path
-    }
+    return RespuestaORJSON(
+        status_code=500,
+        content={
+            "success": False,
+            "error": str(exc),
+            "path": request.url.path
+        }
+    )
 
 
 # =============================================================================
@@ -1109,11 +2476,34 @@ if __name__ == "__main__":
     # Obtener puerto de la variable de entorno (para Render, Railway, etc.)
     port = int(os.environ.get("PORT", 8000))
     
-    logger.info(f"Iniciando servidor en puerto {port}")
+    # Event loop (libuv) y parser HTTP en C si están instalados
+    # (uvloop no está disponible en Windows)
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    
+    try:
+        import httptools  # noqa: F401
+        http = "httptools"
+    except ImportError:
+        http = "h11"
+    
+    # Un solo worker por defecto: la cola de trades, las caches y las
+    # resoluciones en curso (single-flight) son estado en memoria del proceso,
+    # y varios workers podrían crear la misma cuenta/estrategia en Notion
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    
+    logger.info("Iniciando servidor en puerto %s (loop=%s, http=%s, workers=%s)",
+                port, loop, http, workers)
     
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
+        loop=loop,
+        http=http,
+        workers=workers,
         reload=False
     )